@@ -7,7 +7,8 @@ Gemini-2.5-Pro AIによる高精度予測
 
 import streamlit as st
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from bs4 import BeautifulSoup, SoupStrainer
 import re
 import time
 import math
@@ -16,6 +17,22 @@ from typing import List, Dict, Optional, Tuple
 import google.generativeai as genai
 import os
 import pandas as pd
+import numpy as np
+import diskcache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# HTMLパーサー（lxmlが無ければ標準のhtml.parserを使う）
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+# 過去成績の解析はselectolax（Cパーサー）を優先し、無ければBeautifulSoupで解析
+try:
+    from selectolax.lexbor import LexborHTMLParser as HTMLParser
+except ImportError:
+    HTMLParser = None
 
 # ページ設定
 st.set_page_config(
@@ -71,6 +88,43 @@ HEADERS = {
     'Connection': 'keep-alive',
 }
 
+# netkeibaのページ文字コード（取得したバイト列はパーサー側でデコード）
+PAGE_ENCODING = 'euc-jp'
+
+# 過去成績の並列取得数（サーバー負荷はこの値で調整）
+MAX_FETCH_WORKERS = 8
+
+# 解析用の正規表現（呼び出しごとにコンパイルしない）
+_RE_DIST = re.compile(r'(\d{3,4})m')
+_RE_COND = re.compile(r'(良|稍重|重|不良)')
+_RE_HORSE_ID = re.compile(r'horse/(\d+)')
+_RE_ODDS_ID = re.compile(r'^odds-')
+_RE_SEX = re.compile(r'(牡|牝|セ)')
+_RE_AGE = re.compile(r'(\d+)')
+_RE_WEIGHT = re.compile(r'^(\d{2}\.\d)$')
+_RE_TRACK_DIST = re.compile(r'([芝ダ障])(\d{3,4})')
+
+# 出馬表の斤量列（枠・馬番・印・馬名・性齢の次）
+WEIGHT_COL = 5
+
+# 競馬場名（JRA・地方）
+_COURSE_NAMES = ['東京', '中山', '阪神', '京都', '中京', '新潟', '福島', '小倉', '札幌', '函館',
+                 '大井', '船橋', '川崎', '浦和', '門別', '園田', '姫路', '高知', '佐賀', '名古屋', '笠松', '金沢', '盛岡', '水沢']
+_RE_COURSE = re.compile('|'.join(map(re.escape, _COURSE_NAMES)))
+
+# 解析対象の要素だけを木に残す（ナビ・広告などを構築しない）
+# ※解析中はclass属性が分割されないため、複数クラスにも一致する正規表現で指定
+_RACE_STRAINER = SoupStrainer(class_=re.compile(r'\b(RaceName|RaceData01|RaceData02|HorseList)\b'))
+_HISTORY_STRAINER = SoupStrainer('table', class_=re.compile(r'\b(db_h_race_results|nk_tb_common)\b'))
+
+# 近走成績の重み（前走から順に）と着順スコア表（1着=100、以降12点ずつ減少、0〜30着）
+_RECENT_WEIGHTS = np.array([0.35, 0.25, 0.2, 0.12, 0.08])
+_FINISH_SCORE_LUT = np.clip(100 - (np.arange(31) - 1) * 12, 0, None).astype(np.float64)
+
+# 馬の成績ページのディスクキャッシュ（サーバー再起動後も有効）
+HORSE_PAGE_CACHE_DIR = '.cache/horses'
+HORSE_PAGE_TTL = 24 * 60 * 60
+
 
 @dataclass
 class RaceResult:
@@ -128,18 +182,32 @@ def get_base_url(race_id: str) -> str:
         return "https://race.netkeiba.com"
 
 
+@st.cache_resource
+def _get_session() -> requests.Session:
+    """接続を使い回すための共有セッション（再実行をまたいで保持、スレッド間で共用）"""
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+    return session
+
+
+@st.cache_resource
+def _get_horse_page_cache() -> diskcache.Cache:
+    """馬の成績ページのディスクキャッシュ（再実行のたびに開き直さない）"""
+    return diskcache.Cache(HORSE_PAGE_CACHE_DIR)
+
+
 @st.cache_data(ttl=300)
-def fetch_race_page(race_id: str) -> Optional[str]:
+def fetch_race_page(race_id: str) -> Optional[bytes]:
     """出馬表ページを取得"""
     base_url = get_base_url(race_id)
     url = f"{base_url}/race/shutuba.html?race_id={race_id}"
     
     try:
-        response = requests.get(url, headers=HEADERS, timeout=30)
-        response.encoding = 'euc-jp'
+        response = _get_session().get(url, timeout=30)
         
         if response.status_code == 200:
-            return response.text
+            return response.content
         return None
     except Exception as e:
         st.error(f"接続エラー: {e}")
@@ -147,24 +215,28 @@ def fetch_race_page(race_id: str) -> Optional[str]:
 
 
 @st.cache_data(ttl=300)
-def fetch_horse_page(horse_id: str) -> Optional[str]:
-    """馬の成績ページを取得"""
+def fetch_horse_page(horse_id: str) -> bytes:
+    """馬の成績ページを取得（ディスクキャッシュを優先）
+    
+    失敗時は requests の例外を送出する（st.cache_data は例外をキャッシュしないので次回は取り直す）
+    """
+    cache = _get_horse_page_cache()
+    cached = cache.get(horse_id)
+    if cached:
+        return cached
+    
     url = f"https://db.netkeiba.com/horse/result/{horse_id}/"
     
-    try:
-        response = requests.get(url, headers=HEADERS, timeout=20)
-        response.encoding = 'euc-jp'
-        
-        if response.status_code == 200:
-            return response.text
-        return None
-    except:
-        return None
+    response = _get_session().get(url, timeout=20)
+    response.raise_for_status()
+    
+    cache.set(horse_id, response.content, expire=HORSE_PAGE_TTL)
+    return response.content
 
 
-def parse_race_page(html: str, race_id: str) -> Tuple[RaceInfo, List[Horse]]:
+def parse_race_page(html: bytes, race_id: str) -> Tuple[RaceInfo, List[Horse]]:
     """出馬表ページを解析"""
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = BeautifulSoup(html, HTML_PARSER, from_encoding=PAGE_ENCODING, parse_only=_RACE_STRAINER)
     
     race_info = RaceInfo(race_id=race_id)
     
@@ -178,7 +250,7 @@ def parse_race_page(html: str, race_id: str) -> Tuple[RaceInfo, List[Horse]]:
     if race_data01:
         text = race_data01.get_text()
         
-        dist_match = re.search(r'(\d{3,4})m', text)
+        dist_match = _RE_DIST.search(text)
         if dist_match:
             race_info.distance = int(dist_match.group(1))
         
@@ -187,7 +259,7 @@ def parse_race_page(html: str, race_id: str) -> Tuple[RaceInfo, List[Horse]]:
         elif '芝' in text:
             race_info.track_type = '芝'
         
-        condition_match = re.search(r'(良|稍重|重|不良)', text)
+        condition_match = _RE_COND.search(text)
         if condition_match:
             race_info.track_condition = condition_match.group(1)
     
@@ -195,11 +267,9 @@ def parse_race_page(html: str, race_id: str) -> Tuple[RaceInfo, List[Horse]]:
     race_data02 = soup.select_one('.RaceData02')
     if race_data02:
         text = race_data02.get_text()
-        for course_name in ['東京', '中山', '阪神', '京都', '中京', '新潟', '福島', '小倉', '札幌', '函館',
-                           '大井', '船橋', '川崎', '浦和', '門別', '園田', '姫路', '高知', '佐賀', '名古屋', '笠松', '金沢', '盛岡', '水沢']:
-            if course_name in text:
-                race_info.course = course_name
-                break
+        course_match = _RE_COURSE.search(text)
+        if course_match:
+            race_info.course = course_match.group(0)
     
     # 馬データを取得
     horses = []
@@ -207,11 +277,29 @@ def parse_race_page(html: str, race_id: str) -> Tuple[RaceInfo, List[Horse]]:
     
     for row in horse_rows:
         horse = Horse()
+        cells = row.find_all('td', recursive=False)
+        
+        # セルをクラス名で振り分け（CSSセレクタを使わず1回の走査で済ませる）
+        waku_cell = umaban_cell = barei_cell = jockey_cell = trainer_cell = None
+        popular_cells = []
+        for td in cells:
+            classes = td.get('class') or []
+            if waku_cell is None and any(c.startswith('Waku') for c in classes):
+                waku_cell = td
+            elif umaban_cell is None and any(c.startswith('Umaban') for c in classes):
+                umaban_cell = td
+            elif barei_cell is None and 'Barei' in classes:
+                barei_cell = td
+            elif jockey_cell is None and 'Jockey' in classes:
+                jockey_cell = td
+            elif trainer_cell is None and 'Trainer' in classes:
+                trainer_cell = td
+            elif 'Popular' in classes:
+                popular_cells.append(td)
         
         # 枠番
-        waku_cell = row.select_one('td[class*="Waku"]')
         if waku_cell:
-            span = waku_cell.select_one('span')
+            span = waku_cell.find('span')
             if span:
                 try:
                     horse.gate = int(span.get_text(strip=True))
@@ -219,57 +307,61 @@ def parse_race_page(html: str, race_id: str) -> Tuple[RaceInfo, List[Horse]]:
                     pass
         
         # 馬番
-        umaban_cell = row.select_one('td[class*="Umaban"]')
         if umaban_cell:
             text = umaban_cell.get_text(strip=True)
             if text.isdigit():
                 horse.number = int(text)
         
         # 馬名とID
-        horse_name_link = row.select_one('span.HorseName a')
+        horse_name_span = row.find('span', class_='HorseName')
+        horse_name_link = horse_name_span.find('a') if horse_name_span else None
         if horse_name_link:
             horse.name = horse_name_link.get('title', '') or horse_name_link.get_text(strip=True)
             href = horse_name_link.get('href', '')
-            id_match = re.search(r'horse/(\d+)', href)
+            id_match = _RE_HORSE_ID.search(href)
             if id_match:
                 horse.horse_id = id_match.group(1)
         
         # 性齢
-        barei_cell = row.select_one('td.Barei')
         if barei_cell:
             text = barei_cell.get_text(strip=True)
-            sex_match = re.search(r'(牡|牝|セ)', text)
-            age_match = re.search(r'(\d+)', text)
+            sex_match = _RE_SEX.search(text)
+            age_match = _RE_AGE.search(text)
             if sex_match:
                 horse.sex = sex_match.group(1)
             if age_match:
                 horse.age = int(age_match.group(1))
         
-        # 斤量
-        cells = row.select('td')
-        for cell in cells:
-            text = cell.get_text(strip=True)
-            weight_match = re.match(r'^(\d{2}\.\d)$', text)
-            if weight_match:
-                horse.weight_carry = float(weight_match.group(1))
-                break
+        # 斤量（通常は固定列、レイアウトが違う場合のみ全セルを走査）
+        weight_match = None
+        if len(cells) > WEIGHT_COL:
+            weight_match = _RE_WEIGHT.match(cells[WEIGHT_COL].get_text(strip=True))
+        if not weight_match:
+            for cell in cells:
+                weight_match = _RE_WEIGHT.match(cell.get_text(strip=True))
+                if weight_match:
+                    break
+        if weight_match:
+            horse.weight_carry = float(weight_match.group(1))
         
         # 騎手
-        jockey_cell = row.select_one('td.Jockey')
         if jockey_cell:
-            jockey_link = jockey_cell.select_one('a')
+            jockey_link = jockey_cell.find('a')
             if jockey_link:
                 horse.jockey = jockey_link.get_text(strip=True)
         
         # 調教師
-        trainer_cell = row.select_one('td.Trainer')
         if trainer_cell:
-            trainer_link = trainer_cell.select_one('a')
+            trainer_link = trainer_cell.find('a')
             if trainer_link:
                 horse.trainer = trainer_link.get_text(strip=True)
         
         # オッズ
-        odds_span = row.select_one('td.Popular span[id^="odds-"]')
+        odds_span = None
+        for popular_cell in popular_cells:
+            odds_span = popular_cell.find('span', id=_RE_ODDS_ID)
+            if odds_span:
+                break
         if odds_span:
             try:
                 odds_text = odds_span.get_text(strip=True)
@@ -284,9 +376,85 @@ def parse_race_page(html: str, race_id: str) -> Tuple[RaceInfo, List[Horse]]:
     return race_info, horses
 
 
-def parse_horse_history(html: str) -> List[RaceResult]:
-    """馬の過去成績を解析"""
-    soup = BeautifulSoup(html, 'html.parser')
+# 成績表でリンク文字列を優先する列（日付・開催・レース名）
+_HISTORY_LINK_COLS = (0, 1, 4)
+
+
+def _build_race_result(texts: List[str]) -> Optional[RaceResult]:
+    """成績表1行分のセル文字列からRaceResultを作成（着順が数字でなければNone）"""
+    result = RaceResult()
+    
+    result.date = texts[0]
+    result.course = texts[1]
+    result.race_name = texts[4]
+    
+    try:
+        result.total_horses = int(texts[6])
+    except:
+        pass
+    
+    finish_text = texts[11]
+    if finish_text.isdigit():
+        result.finish = int(finish_text)
+    else:
+        return None
+    
+    dist_match = _RE_TRACK_DIST.search(texts[14])
+    if dist_match:
+        result.track_type = 'ダート' if dist_match.group(1) == 'ダ' else '芝'
+        result.distance = int(dist_match.group(2))
+    
+    try:
+        result.odds = float(texts[9])
+    except:
+        pass
+    
+    try:
+        result.popularity = int(texts[10])
+    except:
+        pass
+    
+    return result
+
+
+def _parse_horse_history_selectolax(html: bytes) -> List[RaceResult]:
+    """馬の過去成績を解析（selectolax版）"""
+    # lexborはバイト列をUTF-8として扱うため、EUC-JPはここでデコードする
+    if isinstance(html, bytes):
+        html = html.decode(PAGE_ENCODING, errors='replace')
+    tree = HTMLParser(html)
+    results = []
+    
+    table = tree.css_first('table.db_h_race_results')
+    if table is None:
+        table = tree.css_first('table.nk_tb_common')
+    
+    if table is None:
+        return results
+    
+    tbody = table.css_first('tbody')
+    rows = tbody.css('tr') if tbody is not None else table.css('tr')
+    
+    for row in rows:
+        cells = row.css('td')
+        if len(cells) < 15:
+            continue
+        
+        texts = []
+        for i, cell in enumerate(cells[:15]):
+            link = cell.css_first('a') if i in _HISTORY_LINK_COLS else None
+            texts.append((link if link is not None else cell).text(strip=True))
+        
+        result = _build_race_result(texts)
+        if result:
+            results.append(result)
+    
+    return results[:20]
+
+
+def _parse_horse_history_bs4(html: bytes) -> List[RaceResult]:
+    """馬の過去成績を解析（BeautifulSoup版）"""
+    soup = BeautifulSoup(html, HTML_PARSER, from_encoding=PAGE_ENCODING, parse_only=_HISTORY_STRAINER)
     results = []
     
     table = soup.select_one('table.db_h_race_results')
@@ -304,78 +472,70 @@ def parse_horse_history(html: str) -> List[RaceResult]:
         if len(cells) < 15:
             continue
         
-        result = RaceResult()
-        
-        try:
-            date_link = cells[0].select_one('a')
-            result.date = date_link.get_text(strip=True) if date_link else cells[0].get_text(strip=True)
-            
-            course_link = cells[1].select_one('a')
-            result.course = course_link.get_text(strip=True) if course_link else cells[1].get_text(strip=True)
-            
-            race_link = cells[4].select_one('a')
-            result.race_name = race_link.get_text(strip=True) if race_link else cells[4].get_text(strip=True)
-            
-            try:
-                result.total_horses = int(cells[6].get_text(strip=True))
-            except:
-                pass
-            
-            finish_text = cells[11].get_text(strip=True)
-            if finish_text.isdigit():
-                result.finish = int(finish_text)
-            else:
-                continue
-            
-            dist_text = cells[14].get_text(strip=True)
-            dist_match = re.search(r'([芝ダ障])(\d{3,4})', dist_text)
-            if dist_match:
-                result.track_type = 'ダート' if dist_match.group(1) == 'ダ' else '芝'
-                result.distance = int(dist_match.group(2))
-            
-            try:
-                result.odds = float(cells[9].get_text(strip=True))
-            except:
-                pass
-            
-            try:
-                result.popularity = int(cells[10].get_text(strip=True))
-            except:
-                pass
-            
+        texts = []
+        for i, cell in enumerate(cells[:15]):
+            link = cell.select_one('a') if i in _HISTORY_LINK_COLS else None
+            texts.append((link if link else cell).get_text(strip=True))
+        
+        result = _build_race_result(texts)
+        if result:
             results.append(result)
-            
-        except:
-            continue
     
     return results[:20]
 
 
-def calculate_score(horse: Horse, race_info: RaceInfo, all_horses: List[Horse]) -> Dict:
+def parse_horse_history(html: bytes) -> List[RaceResult]:
+    """馬の過去成績を解析"""
+    if HTMLParser is not None:
+        return _parse_horse_history_selectolax(html)
+    return _parse_horse_history_bs4(html)
+
+
+@st.cache_data(ttl=24 * 60 * 60, show_spinner=False)
+def load_horse_results(horse_id: str) -> List[RaceResult]:
+    """馬の過去成績を取得・解析（解析結果を1日キャッシュ、取得失敗時は例外を送出しキャッシュしない）"""
+    if not horse_id:
+        return []
+    return parse_horse_history(fetch_horse_page(horse_id))
+
+
+def calculate_score(horse: Horse, race_info: RaceInfo, n_horses: int, avg_weight: float) -> Dict:
     """馬のスコアを計算"""
     score_details = {}
     total_score = 0
     
     results = horse.results
     
+    # 過去成績を1回の走査で集計
+    finishes = []
+    wins = places = 0
+    dist_runs = dist_places = 0
+    course_runs = course_places = 0
+    for r in results:
+        placed = r.finish <= 3
+        finishes.append(r.finish)
+        if r.finish == 1:
+            wins += 1
+        if placed:
+            places += 1
+        if race_info.distance and abs(r.distance - race_info.distance) <= 100:
+            dist_runs += 1
+            dist_places += placed
+        if race_info.course and race_info.course in r.course:
+            course_runs += 1
+            course_places += placed
+    
     # 近走成績 (35%)
     recent_score = 50
     if results:
-        weights = [0.35, 0.25, 0.2, 0.12, 0.08]
-        weighted_sum = 0
-        for i, r in enumerate(results[:5]):
-            if i < len(weights):
-                finish_score = max(0, 100 - (r.finish - 1) * 12)
-                weighted_sum += finish_score * weights[i]
-        recent_score = weighted_sum
+        finish_idx = np.minimum(finishes[:5], 30)
+        recent_score = float(_FINISH_SCORE_LUT[finish_idx] @ _RECENT_WEIGHTS[:finish_idx.size])
     score_details['recent'] = recent_score
     total_score += recent_score * 0.40
     
     # 勝率・複勝率 (15%)
     basic_score = 50
     if results:
-        wins = sum(1 for r in results if r.finish == 1)
-        places = sum(1 for r in results if r.finish <= 3)
         win_rate = wins / len(results)
         place_rate = places / len(results)
         basic_score = win_rate * 50 + place_rate * 50
@@ -384,29 +544,22 @@ def calculate_score(horse: Horse, race_info: RaceInfo, all_horses: List[Horse])
     
     # 距離適性 (12%)
     distance_score = 50
-    if results and race_info.distance:
-        same_dist = [r for r in results if abs(r.distance - race_info.distance) <= 100]
-        if same_dist:
-            places = sum(1 for r in same_dist if r.finish <= 3)
-            distance_score = (places / len(same_dist)) * 100
+    if dist_runs:
+        distance_score = (dist_places / dist_runs) * 100
     score_details['distance'] = distance_score
     total_score += distance_score * 0.11
     
     # コース適性 (8%)
     course_score = 50
-    if results and race_info.course:
-        same_course = [r for r in results if race_info.course in r.course]
-        if same_course:
-            places = sum(1 for r in same_course if r.finish <= 3)
-            course_score = (places / len(same_course)) * 100
+    if course_runs:
+        course_score = (course_places / course_runs) * 100
     score_details['course'] = course_score
     total_score += course_score * 0.08
     
     # 枠順 (8%)
     draw_score = 50
-    total = len(all_horses)
-    if horse.number and total > 0:
-        position = (horse.number - 1) / max(total - 1, 1)
+    if horse.number and n_horses > 0:
+        position = (horse.number - 1) / max(n_horses - 1, 1)
         inner_bias = 0.2 if race_info.distance <= 1400 else 0.1
         draw_score = (1 - position * inner_bias) * 100
     score_details['draw'] = draw_score
@@ -422,18 +575,15 @@ def calculate_score(horse: Horse, race_info: RaceInfo, all_horses: List[Horse])
     # 安定性 (7%)
     stability_score = 50
     if len(results) >= 3:
-        finishes = [r.finish for r in results[:10]]
-        import statistics
-        std = statistics.stdev(finishes) if len(finishes) > 1 else 0
+        recent_finishes = np.array(finishes[:10], dtype=np.int16)
+        std = float(recent_finishes.std(ddof=1)) if recent_finishes.size > 1 else 0.0
         stability_score = max(0, 100 - std * 12)
     score_details['stability'] = stability_score
     total_score += stability_score * 0.07
     
     # 斤量 (5%)
     weight_score = 50
-    weights = [h.weight_carry for h in all_horses if h.weight_carry > 0]
-    if weights and horse.weight_carry:
-        avg_weight = sum(weights) / len(weights)
+    if avg_weight and horse.weight_carry:
         diff = horse.weight_carry - avg_weight
         weight_score = 50 - diff * 8
         weight_score = max(0, min(100, weight_score))
@@ -450,8 +600,14 @@ def predict(horses: List[Horse], race_info: RaceInfo) -> List[Dict]:
     """予測を実行"""
     predictions = []
     
+    # 全馬共通の値は一度だけ計算
+    n_horses = len(horses)
+    weight_carry = np.array([h.weight_carry for h in horses], dtype=np.float64)
+    carried = weight_carry > 0
+    avg_weight = float(weight_carry[carried].mean()) if carried.any() else 0.0
+    
     for horse in horses:
-        score_data = calculate_score(horse, race_info, horses)
+        score_data = calculate_score(horse, race_info, n_horses, avg_weight)
         predictions.append({
             'horse': horse,
             'score': score_data['total'],
@@ -460,19 +616,17 @@ def predict(horses: List[Horse], race_info: RaceInfo) -> List[Dict]:
     
     predictions.sort(key=lambda x: x['score'], reverse=True)
     
-    scores = [p['score'] for p in predictions]
-    min_s, max_s = min(scores), max(scores)
+    scores = np.fromiter((p['score'] for p in predictions), dtype=np.float64, count=len(predictions))
+    min_s, max_s = scores.min(), scores.max()
+    norm = (scores - min_s) / (max_s - min_s) if max_s > min_s else np.full_like(scores, 0.5)
     
     temperature = 0.3
-    exp_scores = []
-    for p in predictions:
-        norm = (p['score'] - min_s) / (max_s - min_s) if max_s > min_s else 0.5
-        p['norm_score'] = norm
-        exp_scores.append(math.exp(norm / temperature))
-    
-    total_exp = sum(exp_scores)
-    for i, p in enumerate(predictions):
-        p['win_prob'] = exp_scores[i] / total_exp
+    exp_scores = np.exp(norm / temperature)
+    win_probs = exp_scores / exp_scores.sum()
+    
+    for i, (p, n, w) in enumerate(zip(predictions, norm, win_probs)):
+        p['norm_score'] = float(n)
+        p['win_prob'] = float(w)
         p['rank'] = i + 1
         
         if p['horse'].odds and p['horse'].odds > 0:
@@ -483,30 +637,36 @@ def predict(horses: List[Horse], race_info: RaceInfo) -> List[Dict]:
     return predictions
 
 
-def get_gemini_analysis(race_info: RaceInfo, horses: List[Horse], predictions: List[Dict], api_key: str) -> str:
-    """Gemini AIによる分析"""
-    try:
-        genai.configure(api_key=api_key)
-        # gemini-2.0-flash は無料枠で利用可能
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        
-        # レース情報を整形
-        race_summary = f"""
+@st.cache_resource
+def _get_gemini_model(api_key: str):
+    """Geminiモデルを生成（APIキーごとに使い回す）"""
+    genai.configure(api_key=api_key)
+    # gemini-2.0-flash は無料枠で利用可能
+    return genai.GenerativeModel('gemini-2.0-flash')
+
+
+def get_gemini_analysis(race_info: RaceInfo, horses: List[Horse], predictions: List[Dict], model: genai.GenerativeModel) -> genai.types.GenerateContentResponse:
+    """Gemini AIによる分析（ストリーミング応答を返し、表示側で逐次描画する）
+    
+    バックグラウンドのスレッドから呼ぶため、Streamlitの機能は使わない（model は呼び出し側で取得）
+    """
+    # レース情報を整形
+    race_summary = f"""
 レース: {race_info.race_name}
 競馬場: {race_info.course}
 距離: {race_info.distance}m ({race_info.track_type})
 馬場状態: {race_info.track_condition or '不明'}
 出走頭数: {len(horses)}頭
 """
-        
-        # 馬情報を整形
-        horse_data = []
-        for p in predictions[:10]:  # 上位10頭
-            h = p['horse']
-            recent = '-'.join(str(r.finish) for r in h.results[:5]) if h.results else '新馬'
-            horse_data.append(f"  {p['rank']}位 {h.number}番 {h.name} ({h.sex}{h.age}) 騎手:{h.jockey} 近走:{recent} 勝率予測:{p['win_prob']*100:.1f}%")
-        
-        prompt = f"""あなたは競馬予想の専門家です。以下のレース情報と出走馬データを分析し、予想と解説を日本語で提供してください。
+    
+    # 馬情報を整形
+    horse_data = []
+    for p in predictions[:10]:  # 上位10頭
+        h = p['horse']
+        recent = '-'.join(str(r.finish) for r in h.results[:5]) if h.results else '新馬'
+        horse_data.append(f"  {p['rank']}位 {h.number}番 {h.name} ({h.sex}{h.age}) 騎手:{h.jockey} 近走:{recent} 勝率予測:{p['win_prob']*100:.1f}%")
+    
+    prompt = f"""あなたは競馬予想の専門家です。以下のレース情報と出走馬データを分析し、予想と解説を日本語で提供してください。
 
 【レース情報】
 {race_summary}
@@ -524,12 +684,8 @@ def get_gemini_analysis(race_info: RaceInfo, horses: List[Horse], predictions: L
 
 簡潔かつ的確に分析してください（500文字程度）。
 """
-        
-        response = model.generate_content(prompt)
-        return response.text
-        
-    except Exception as e:
-        return f"AI分析エラー: {str(e)}"
+    
+    return model.generate_content(prompt, stream=True)
 
 
 def main():
@@ -604,25 +760,33 @@ def main():
         
         # 3. 各馬の成績取得
         status_text.text("📈 各馬の過去成績を取得中...")
-        for i, horse in enumerate(horses):
-            if horse.horse_id:
-                horse_html = fetch_horse_page(horse.horse_id)
-                if horse_html:
-                    horse.results = parse_horse_history(horse_html)
-            progress_bar.progress(20 + int(50 * (i + 1) / len(horses)))
-            time.sleep(0.2)
+        with ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS) as executor:
+            futures = {executor.submit(load_horse_results, h.horse_id): h for h in horses}
+            failed = []
+            for i, future in enumerate(as_completed(futures)):
+                try:
+                    futures[future].results = future.result()
+                except requests.RequestException:
+                    # 取得できなかった馬は成績なしで予測（キャッシュされないので次回は取り直す）
+                    failed.append(futures[future])
+                progress_bar.progress(20 + int(50 * (i + 1) / len(horses)))
+        if failed:
+            names = '、'.join(f"{h.number}番 {h.name}" for h in sorted(failed, key=lambda h: h.number))
+            st.warning(f"⚠️ 過去成績を取得できませんでした: {names}")
         
         # 4. 予測実行
         status_text.text("🔮 予測モデルを実行中...")
         progress_bar.progress(75)
         predictions = predict(horses, race_info)
         
-        # 5. AI分析
-        ai_analysis = ""
+        # 5. AI分析（結果表示と並行してバックグラウンドで開始）
+        ai_future = None
         if api_key:
-            status_text.text("🤖 Gemini AI分析中...")
-            progress_bar.progress(85)
-            ai_analysis = get_gemini_analysis(race_info, horses, predictions, api_key)
+            # st.cache_resource はスクリプトのスレッドで呼ぶ（別スレッドには ScriptRunContext が無い）
+            model = _get_gemini_model(api_key)
+            ai_executor = ThreadPoolExecutor(max_workers=1)
+            ai_future = ai_executor.submit(get_gemini_analysis, race_info, horses, predictions, model)
+            ai_executor.shutdown(wait=False)
         
         progress_bar.progress(100)
         status_text.text("✅ 完了!")
@@ -674,23 +838,18 @@ def main():
         # 全馬データテーブル
         st.header("📋 全出走馬データ")
         
-        table_data = []
-        for p in predictions:
-            h = p['horse']
-            recent = '-'.join(str(r.finish) for r in h.results[:3]) if h.results else '-'
-            table_data.append({
-                '順位': p['rank'],
-                '馬番': h.number,
-                '馬名': h.name,
-                '性齢': f"{h.sex}{h.age}",
-                '騎手': h.jockey,
-                '斤量': h.weight_carry,
-                '近走': recent,
-                '勝率': f"{p['win_prob']*100:.1f}%",
-                'スコア': f"{p['norm_score']:.3f}",
-            })
-        
-        df = pd.DataFrame(table_data)
+        horses_ranked = [p['horse'] for p in predictions]
+        df = pd.DataFrame({
+            '順位': [p['rank'] for p in predictions],
+            '馬番': [h.number for h in horses_ranked],
+            '馬名': [h.name for h in horses_ranked],
+            '性齢': [f"{h.sex}{h.age}" for h in horses_ranked],
+            '騎手': [h.jockey for h in horses_ranked],
+            '斤量': [h.weight_carry for h in horses_ranked],
+            '近走': ['-'.join(str(r.finish) for r in h.results[:3]) if h.results else '-' for h in horses_ranked],
+            '勝率': [f"{p['win_prob']*100:.1f}%" for p in predictions],
+            'スコア': [f"{p['norm_score']:.3f}" for p in predictions],
+        })
         st.dataframe(df, use_container_width=True, hide_index=True)
         
         st.markdown("---")
@@ -713,18 +872,25 @@ def main():
             st.markdown(f"**3連複**: {top5[0]['horse'].number}-{top5[1]['horse'].number}-{top5[2]['horse'].number}")
             st.markdown(f"**3連単**: {top5[0]['horse'].number}→{top5[1]['horse'].number}→{top5[2]['horse'].number}")
             # 期待値上位
-            ev_sorted = sorted([p for p in predictions if p['expected_value'] > 0], 
-                              key=lambda x: x['expected_value'], reverse=True)
-            if ev_sorted:
-                st.markdown(f"**穴狙い**: {ev_sorted[0]['horse'].number}番 (期待値: {ev_sorted[0]['expected_value']:.2f})")
+            ev_top = max((p for p in predictions if p['expected_value'] > 0),
+                         key=lambda x: x['expected_value'], default=None)
+            if ev_top:
+                st.markdown(f"**穴狙い**: {ev_top['horse'].number}番 (期待値: {ev_top['expected_value']:.2f})")
         
         st.markdown("---")
         
-        # AI分析
-        if ai_analysis:
+        # AI分析（生成されたそばから表示）
+        if ai_future:
             st.header("🤖 Gemini AI分析")
-            st.markdown(ai_analysis)
-        elif not api_key:
+            placeholder = st.empty()
+            ai_analysis = ""
+            try:
+                for chunk in ai_future.result():
+                    ai_analysis += chunk.text
+                    placeholder.markdown(ai_analysis)
+            except Exception as e:
+                placeholder.markdown(f"{ai_analysis}\n\nAI分析エラー: {str(e)}")
+        else:
             st.info("💡 Gemini API Keyを入力すると、AIによる詳細分析が表示されます")
         
         st.markdown("---")
@@ -5,14 +5,36 @@
 出馬表と各馬の過去成績を取得し、勝ち馬を予測する
 """
 
+import asyncio
+import aiohttp
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, NavigableString, SoupStrainer
+import soupsieve as sv
+from lxml import etree, html as lxml_html
 import re
 import time
 import math
+from itertools import islice
+import pickle
+import numpy as np
 from dataclasses import dataclass, field
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Iterable, Optional, Tuple
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+# BeautifulSoupのパーサー
+HTML_PARSER = 'lxml'
+
+# HTMLの解析にはselectolax（lexbor、Cパーサー）を優先する
+# 無い環境（ホイールが無いプラットフォームなど）では出馬表はBeautifulSoup、過去成績はlxmlで解析
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
 
 # リクエスト設定
 HEADERS = {
@@ -22,8 +44,71 @@ HEADERS = {
     'Connection': 'keep-alive',
 }
 
+# netkeibaのページの文字コード
+PAGE_ENCODING = 'euc-jp'
+
+# 出馬表取得用のセッション（同一ホストへの接続を使い回す）
+_SESSION = requests.Session()
+_SESSION.headers.update(HEADERS)
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=2, backoff_factor=0.3),
+))
+
+# 取得したHTMLのキャッシュ（再実行時に同じページを取り直さない）
+CACHE_DIR = Path('.cache_netkeiba')
+RACE_PAGE_TTL = 15 * 60          # 出馬表はオッズが変わるので短め
+HORSE_PAGE_TTL = 24 * 60 * 60    # 馬の成績は1日
+
+# 各馬の成績ページの同時取得数（サーバー負荷軽減のため上限を設ける）
+MAX_CONCURRENT_FETCHES = 6
+
+# 同一ドメインへのリクエスト間隔（秒）
+MIN_REQUEST_INTERVAL = 0.25
+
+# 複数レースを予測する場合のプロセス数の上限
+# （同時取得数とリクエスト間隔はプロセス数で割り振り、全体の負荷は1プロセスの場合と同じに保つ）
+MAX_BATCH_WORKERS = 4
 
-@dataclass
+# BeautifulSoup版で使うCSSセレクタ（行ごとに再パースしないよう事前にコンパイル）
+_SEL_RACE_NAME = sv.compile('.RaceName')
+_SEL_RACE_DATA01 = sv.compile('.RaceData01')
+_SEL_RACE_DATA02 = sv.compile('.RaceData02')
+_SEL_ROW = sv.compile('tr.HorseList')
+_SEL_WAKU = sv.compile('td[class*="Waku"]')
+_SEL_UMABAN = sv.compile('td[class*="Umaban"]')
+_SEL_HORSE_NAME = sv.compile('span.HorseName a')
+_SEL_BAREI = sv.compile('td.Barei')
+_SEL_JOCKEY_WEIGHT = sv.compile('td.JockeyWeight')
+_SEL_JOCKEY = sv.compile('td.Jockey a')
+_SEL_TRAINER = sv.compile('td.Trainer a')
+_SEL_ODDS = sv.compile('td.Popular span[id^="odds-"]')
+_SEL_NINKI = sv.compile('td.Popular_Ninki')
+_SEL_TD = sv.compile('td')
+_SEL_SPAN = sv.compile('span')
+
+# 解析用の正規表現（呼び出しごとにコンパイルしない）
+_RE_RESULTS_TABLE_OPEN = re.compile(rb'<table[^>]*db_h_race_results')
+_TABLE_CLOSE = b'</table>'
+_RE_DIST = re.compile(r'(\d{3,4})m')
+_RE_WEATHER = re.compile(r'天候:(\S+)')
+_RE_COND = re.compile(r'(良|稍重|重|不良)')
+_RE_HORSE_ID = re.compile(r'horse/(\d+)')
+_RE_SEX = re.compile(r'(牡|牝|セ)')
+_RE_AGE = re.compile(r'(\d+)')
+_RE_WEIGHT = re.compile(r'^(\d{2}\.\d)$')
+_RE_TRACK_DIST = re.compile(r'([芝ダ障])(\d{3,4})')
+
+# 出馬表の斤量列（枠・馬番・印・馬名・性齢の次）
+WEIGHT_COL = 5
+
+# BeautifulSoupで解析する場合に木に残す要素（ナビ・広告・スクリプトなどは構築しない）
+# ※解析中はclass属性が分割されないため、複数クラスにも一致する正規表現で指定
+_RACE_STRAINER = SoupStrainer(class_=re.compile(r'\b(RaceName|RaceData01|RaceData02|HorseList)\b'))
+
+
+@dataclass(slots=True)
 class RaceResult:
     """過去レース結果"""
     date: str = ""
@@ -40,7 +125,7 @@ class RaceResult:
     weight_diff: str = ""
 
 
-@dataclass 
+@dataclass(slots=True)
 class Horse:
     """馬データ"""
     number: int = 0
@@ -59,7 +144,7 @@ class Horse:
     results: List[RaceResult] = field(default_factory=list)
 
 
-@dataclass
+@dataclass(slots=True)
 class RaceInfo:
     """レース情報"""
     race_id: str = ""
@@ -74,6 +159,22 @@ class RaceInfo:
     start_time: str = ""
 
 
+class DomainRateLimiter:
+    """ドメインごとのリクエスト間隔を制御（前回から不足している分だけ待つ）"""
+    
+    def __init__(self, min_delay: float = MIN_REQUEST_INTERVAL):
+        self.min_delay = min_delay
+        self.last: Dict[str, float] = {}
+    
+    async def wait(self, host: str) -> None:
+        """host への次のリクエストが可能になるまで待機"""
+        now = time.monotonic()
+        # 待つ前に枠を予約するので、並行するタスク同士でも間隔が保たれる
+        slot = max(now, self.last.get(host, 0.0) + self.min_delay)
+        self.last[host] = slot
+        await asyncio.sleep(slot - now)
+
+
 def get_base_url(race_id: str) -> str:
     """レースIDからベースURLを決定（JRA or 地方）"""
     # 地方競馬のコードは3桁目が4（例: 202542...）、JRAは0（例: 202508...）など
@@ -83,183 +184,344 @@ def get_base_url(race_id: str) -> str:
         return "https://race.netkeiba.com"
 
 
-def fetch_race_page(race_id: str) -> Optional[str]:
-    """出馬表ページを取得"""
+def _read_cache(path: Path, ttl: float) -> Optional[str]:
+    """キャッシュが有効期限内ならその内容を返す"""
+    try:
+        if time.time() - path.stat().st_mtime < ttl:
+            return path.read_text(encoding='utf-8')
+    except OSError:
+        pass
+    return None
+
+
+def _cache_tmp_path(path: Path) -> Path:
+    """書き込み途中のファイルを他プロセスに読ませないための一時ファイル名"""
+    return path.with_name(f'{path.name}.{os.getpid()}.tmp')
+
+
+def _write_cache(path: Path, html: str) -> None:
+    """HTMLをキャッシュに保存（失敗しても処理は続ける）"""
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        tmp_path = _cache_tmp_path(path)
+        tmp_path.write_text(html, encoding='utf-8')
+        tmp_path.replace(path)
+    except OSError:
+        pass
+
+
+def fetch_race_page(race_id: str, verbose: bool = True) -> Optional[str]:
+    """出馬表ページを取得（verbose=False なら進捗を表示しない）"""
     base_url = get_base_url(race_id)
     url = f"{base_url}/race/shutuba.html?race_id={race_id}"
-    print(f"出馬表を取得中: {url}")
+    if verbose:
+        print(f"出馬表を取得中: {url}")
+    
+    cache_path = CACHE_DIR / f'race_{race_id}.html'
+    cached = _read_cache(cache_path, RACE_PAGE_TTL)
+    if cached is not None:
+        if verbose:
+            print(f"  ✓ キャッシュから取得 ({len(cached)} bytes)")
+        return cached
     
     try:
-        response = requests.get(url, headers=HEADERS, timeout=30)
-        response.encoding = 'euc-jp'
+        response = _SESSION.get(url, timeout=30)
         
         if response.status_code == 200:
-            print(f"  ✓ 取得成功 ({len(response.text)} bytes)")
-            return response.text
+            # 文字コードは固定なので自動判定させずに1回だけデコード
+            html = response.content.decode(PAGE_ENCODING, errors='replace')
+            if verbose:
+                print(f"  ✓ 取得成功 ({len(html)} bytes)")
+            _write_cache(cache_path, html)
+            return html
         else:
-            print(f"  ✗ エラー: HTTP {response.status_code}")
+            if verbose:
+                print(f"  ✗ エラー: HTTP {response.status_code}")
             return None
     except Exception as e:
-        print(f"  ✗ エラー: {e}")
+        if verbose:
+            print(f"  ✗ エラー: {e}")
         return None
 
 
-def fetch_horse_page(horse_id: str) -> Optional[str]:
-    """馬の成績ページを取得"""
+def _cut_after_results_table(body: bytes) -> bytes:
+    """成績テーブルの閉じタグより後ろを切り捨てる（テーブルが無ければそのまま返す）"""
+    m = _RE_RESULTS_TABLE_OPEN.search(body)
+    if m is None:
+        return body
+    end = body.find(_TABLE_CLOSE, m.end())
+    if end < 0:
+        return body
+    return body[:end + len(_TABLE_CLOSE)]
+
+
+async def fetch_horse_page(session: aiohttp.ClientSession, horse_id: str,
+                           limiter: Optional[DomainRateLimiter] = None) -> Optional[bytes]:
+    """馬の成績ページを取得（limiter があれば間隔を空けて取得）"""
     # 成績データは /horse/result/ から取得する
     url = f"https://db.netkeiba.com/horse/result/{horse_id}/"
     
+    if limiter is not None:
+        await limiter.wait("db.netkeiba.com")
+    
     try:
-        response = requests.get(url, headers=HEADERS, timeout=20)
-        response.encoding = 'euc-jp'
-        
-        if response.status_code == 200:
-            return response.text
-        return None
-    except:
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=20)) as response:
+            if response.status == 200:
+                # 本文は最後まで読む（途中で打ち切ると接続が使い回されなくなる）
+                return await response.read()
+            return None
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        # 通信エラーは取得失敗として扱う（キャンセルはそのまま伝播させる）
         return None
 
 
-def parse_race_page(html: str, race_id: str) -> Tuple[RaceInfo, List[Horse]]:
-    """出馬表ページを解析"""
-    soup = BeautifulSoup(html, 'html.parser')
-    
-    # レース情報
-    race_info = RaceInfo(race_id=race_id)
-    
-    # レース名
-    race_name_elem = soup.select_one('.RaceName')
-    if race_name_elem:
-        race_info.race_name = race_name_elem.get_text(strip=True)
-    
-    # レースデータ（距離、コースなど）
-    race_data01 = soup.select_one('.RaceData01')
-    if race_data01:
-        text = race_data01.get_text()
-        
+def _apply_race_data(race_info: RaceInfo, data01: Optional[str], data02: Optional[str]) -> None:
+    """RaceData01（距離・コースなど）と RaceData02（競馬場）のテキストを反映"""
+    if data01:
         # 距離
-        dist_match = re.search(r'(\d{3,4})m', text)
+        dist_match = _RE_DIST.search(data01)
         if dist_match:
             race_info.distance = int(dist_match.group(1))
         
         # コースタイプ
-        if 'ダ' in text:
+        if 'ダ' in data01:
             race_info.track_type = 'ダート'
-        elif '芝' in text:
+        elif '芝' in data01:
             race_info.track_type = '芝'
         
         # 天候・馬場状態
-        weather_match = re.search(r'天候:(\S+)', text)
+        weather_match = _RE_WEATHER.search(data01)
         if weather_match:
             race_info.weather = weather_match.group(1)
         
-        condition_match = re.search(r'(良|稍重|重|不良)', text)
+        condition_match = _RE_COND.search(data01)
         if condition_match:
             race_info.track_condition = condition_match.group(1)
     
     # 競馬場
-    race_data02 = soup.select_one('.RaceData02')
-    if race_data02:
-        text = race_data02.get_text()
+    if data02:
         # JRA
         for course_name in ['東京', '中山', '阪神', '京都', '中京', '新潟', '福島', '小倉', '札幌', '函館']:
-            if course_name in text:
+            if course_name in data02:
                 race_info.course = course_name
                 break
         # 地方
         if not race_info.course:
             for course_name in ['大井', '船橋', '川崎', '浦和', '門別', '園田', '姫路', '高知', '佐賀', '名古屋', '笠松', '金沢', '盛岡', '水沢']:
-                if course_name in text:
+                if course_name in data02:
                     race_info.course = course_name
                     break
+
+
+def _build_horse(gate_text: Optional[str], number_text: Optional[str], name: str, href: str,
+                 barei_text: Optional[str], weight_text: Optional[str], cell_texts: Iterable[str],
+                 jockey: Optional[str],
+                 trainer: Optional[str], odds_text: Optional[str], ninki_text: Optional[str]) -> Horse:
+    """出馬表1行分の文字列からHorseを作成（要素が無い項目はNone）
+    
+    cell_texts は斤量セルが見つからない場合にだけ走査する
+    """
+    horse = Horse()
+    
+    # 枠番
+    if gate_text:
+        try:
+            horse.gate = int(gate_text)
+        except:
+            pass
+    
+    # 馬番
+    if number_text and number_text.isdigit():
+        horse.number = int(number_text)
+    
+    # 馬名とID
+    horse.name = name
+    id_match = _RE_HORSE_ID.search(href)
+    if id_match:
+        horse.horse_id = id_match.group(1)
+    
+    # 性齢
+    if barei_text:
+        sex_match = _RE_SEX.search(barei_text)
+        age_match = _RE_AGE.search(barei_text)
+        if sex_match:
+            horse.sex = sex_match.group(1)
+        if age_match:
+            horse.age = int(age_match.group(1))
+    
+    # 斤量 - 通常は50-60台の小数（固定列、レイアウトが違う場合のみ全セルを走査）
+    weight_match = _RE_WEIGHT.match(weight_text) if weight_text else None
+    if not weight_match:
+        for text in cell_texts:
+            weight_match = _RE_WEIGHT.match(text)
+            if weight_match:
+                break
+    if weight_match:
+        horse.weight_carry = float(weight_match.group(1))
+    
+    # 騎手・調教師
+    if jockey:
+        horse.jockey = jockey
+    if trainer:
+        horse.trainer = trainer
+    
+    # オッズ
+    if odds_text and odds_text != '---.-':
+        try:
+            horse.odds = float(odds_text)
+        except:
+            pass
+    
+    # 人気
+    if ninki_text and ninki_text.isdigit():
+        horse.popularity = int(ninki_text)
+    
+    return horse
+
+
+def _parse_race_page_lexbor(html: str, race_id: str) -> Tuple[RaceInfo, List[Horse]]:
+    """出馬表ページを解析（selectolax版）"""
+    tree = LexborHTMLParser(html)
+    
+    # レース情報
+    race_info = RaceInfo(race_id=race_id)
+    
+    race_name_elem = tree.css_first('.RaceName')
+    if race_name_elem is not None:
+        race_info.race_name = race_name_elem.text(strip=True)
+    
+    race_data01 = tree.css_first('.RaceData01')
+    race_data02 = tree.css_first('.RaceData02')
+    _apply_race_data(race_info,
+                     race_data01.text() if race_data01 is not None else None,
+                     race_data02.text() if race_data02 is not None else None)
     
     # 馬データを取得
     horses = []
-    horse_rows = soup.select('tr.HorseList')
     
-    for row in horse_rows:
-        horse = Horse()
+    for row in tree.css('tr.HorseList'):
+        gate_text = None
+        waku_cell = row.css_first('td[class*="Waku"]')
+        if waku_cell is not None:
+            span = waku_cell.css_first('span')
+            gate_text = (span if span is not None else waku_cell).text(strip=True)
         
+        umaban_cell = row.css_first('td[class*="Umaban"]')
+        
+        name = href = ''
+        horse_name_link = row.css_first('span.HorseName a')
+        if horse_name_link is not None:
+            # title属性から馬名を取得（文字化け回避）
+            name = horse_name_link.attributes.get('title') or horse_name_link.text(strip=True)
+            href = horse_name_link.attributes.get('href') or ''
+        
+        barei_cell = row.css_first('td.Barei')
+        cells = row.css('td')
+        weight_cell = row.css_first('td.JockeyWeight')
+        if weight_cell is None and len(cells) > WEIGHT_COL:
+            weight_cell = cells[WEIGHT_COL]
+        jockey_link = row.css_first('td.Jockey a')
+        trainer_link = row.css_first('td.Trainer a')
+        odds_span = row.css_first('td.Popular span[id^="odds-"]')
+        ninki_cell = row.css_first('td.Popular_Ninki')
+        
+        horse = _build_horse(
+            gate_text,
+            umaban_cell.text(strip=True) if umaban_cell is not None else None,
+            name,
+            href,
+            barei_cell.text(strip=True) if barei_cell is not None else None,
+            weight_cell.text(strip=True) if weight_cell is not None else None,
+            (cell.text(strip=True) for cell in cells),
+            jockey_link.text(strip=True) if jockey_link is not None else None,
+            trainer_link.text(strip=True) if trainer_link is not None else None,
+            odds_span.text(strip=True) if odds_span is not None else None,
+            ninki_cell.text(strip=True) if ninki_cell is not None else None,
+        )
+        
+        if horse.name and horse.number > 0:
+            horses.append(horse)
+    
+    return race_info, horses
+
+
+def _bs4_text(tag) -> Optional[str]:
+    """タグのテキストを取得（文字列が1つだけなら get_text を使わず tag.string を返す）"""
+    if tag is None:
+        return None
+    string = tag.string
+    if type(string) is NavigableString:
+        return string.strip()
+    return tag.get_text(strip=True)
+
+
+def _parse_race_page_bs4(html: str, race_id: str) -> Tuple[RaceInfo, List[Horse]]:
+    """出馬表ページを解析（BeautifulSoup版）"""
+    soup = BeautifulSoup(html, HTML_PARSER, parse_only=_RACE_STRAINER)
+    
+    # レース情報
+    race_info = RaceInfo(race_id=race_id)
+    
+    # レース名
+    race_name_elem = _SEL_RACE_NAME.select_one(soup)
+    if race_name_elem:
+        race_info.race_name = race_name_elem.get_text(strip=True)
+    
+    # レースデータ（距離、コースなど）と競馬場
+    race_data01 = _SEL_RACE_DATA01.select_one(soup)
+    race_data02 = _SEL_RACE_DATA02.select_one(soup)
+    _apply_race_data(race_info,
+                     race_data01.get_text() if race_data01 else None,
+                     race_data02.get_text() if race_data02 else None)
+    
+    # 馬データを取得
+    horses = []
+    horse_rows = _SEL_ROW.select(soup)
+    
+    for row in horse_rows:
         # 枠番 - Waku1, Waku2, ... などのクラスを探す
-        waku_cell = row.select_one('td[class*="Waku"]')
+        gate_text = None
+        waku_cell = _SEL_WAKU.select_one(row)
         if waku_cell:
-            span = waku_cell.select_one('span')
-            if span:
-                try:
-                    horse.gate = int(span.get_text(strip=True))
-                except:
-                    pass
-            elif waku_cell.get_text(strip=True).isdigit():
-                horse.gate = int(waku_cell.get_text(strip=True))
+            span = _SEL_SPAN.select_one(waku_cell)
+            gate_text = _bs4_text(span or waku_cell)
         
         # 馬番 - Umaban1, Umaban2, ... などのクラスを探す
-        umaban_cell = row.select_one('td[class*="Umaban"]')
-        if umaban_cell:
-            text = umaban_cell.get_text(strip=True)
-            if text.isdigit():
-                horse.number = int(text)
+        umaban_cell = _SEL_UMABAN.select_one(row)
         
         # 馬名とID - span.HorseName の中の a タグ
-        horse_name_link = row.select_one('span.HorseName a')
+        name = href = ''
+        horse_name_link = _SEL_HORSE_NAME.select_one(row)
         if horse_name_link:
             # title属性から馬名を取得（文字化け回避）
-            horse.name = horse_name_link.get('title', '') or horse_name_link.get_text(strip=True)
+            name = horse_name_link.get('title', '') or _bs4_text(horse_name_link)
             href = horse_name_link.get('href', '')
-            id_match = re.search(r'horse/(\d+)', href)
-            if id_match:
-                horse.horse_id = id_match.group(1)
-        
-        # 性齢
-        barei_cell = row.select_one('td.Barei')
-        if barei_cell:
-            text = barei_cell.get_text(strip=True)
-            sex_match = re.search(r'(牡|牝|セ)', text)
-            age_match = re.search(r'(\d+)', text)
-            if sex_match:
-                horse.sex = sex_match.group(1)
-            if age_match:
-                horse.age = int(age_match.group(1))
-        
-        # 斤量 - td 内のテキストから数字を取得
-        cells = row.select('td')
-        for cell in cells:
-            text = cell.get_text(strip=True)
-            # 斤量は通常50-60台の小数
-            weight_match = re.match(r'^(\d{2}\.\d)$', text)
-            if weight_match:
-                horse.weight_carry = float(weight_match.group(1))
-                break
-        
-        # 騎手
-        jockey_cell = row.select_one('td.Jockey')
-        if jockey_cell:
-            jockey_link = jockey_cell.select_one('a')
-            if jockey_link:
-                horse.jockey = jockey_link.get_text(strip=True)
-        
-        # 調教師
-        trainer_cell = row.select_one('td.Trainer')
-        if trainer_cell:
-            trainer_link = trainer_cell.select_one('a')
-            if trainer_link:
-                horse.trainer = trainer_link.get_text(strip=True)
         
+        barei_cell = _SEL_BAREI.select_one(row)
+        # 斤量 - td.JockeyWeight、無ければ固定列
+        cells = _SEL_TD.select(row)
+        weight_cell = _SEL_JOCKEY_WEIGHT.select_one(row)
+        if weight_cell is None and len(cells) > WEIGHT_COL:
+            weight_cell = cells[WEIGHT_COL]
+        jockey_link = _SEL_JOCKEY.select_one(row)
+        trainer_link = _SEL_TRAINER.select_one(row)
         # オッズ - span#odds-1_XX の形式
-        odds_span = row.select_one('td.Popular span[id^="odds-"]')
-        if odds_span:
-            try:
-                odds_text = odds_span.get_text(strip=True)
-                if odds_text != '---.-':
-                    horse.odds = float(odds_text)
-            except:
-                pass
+        odds_span = _SEL_ODDS.select_one(row)
+        ninki_cell = _SEL_NINKI.select_one(row)
         
-        # 人気
-        ninki_cell = row.select_one('td.Popular_Ninki')
-        if ninki_cell:
-            text = ninki_cell.get_text(strip=True)
-            if text.isdigit():
-                horse.popularity = int(text)
+        horse = _build_horse(
+            gate_text,
+            _bs4_text(umaban_cell),
+            name,
+            href,
+            _bs4_text(barei_cell),
+            _bs4_text(weight_cell),
+            (_bs4_text(cell) for cell in cells),
+            _bs4_text(jockey_link),
+            _bs4_text(trainer_link),
+            _bs4_text(odds_span),
+            _bs4_text(ninki_cell),
+        )
         
         if horse.name and horse.number > 0:
             horses.append(horse)
@@ -267,119 +529,298 @@ def parse_race_page(html: str, race_id: str) -> Tuple[RaceInfo, List[Horse]]:
     return race_info, horses
 
 
-def parse_horse_history(html: str) -> List[RaceResult]:
-    """馬の過去成績を解析"""
-    soup = BeautifulSoup(html, 'html.parser')
+def parse_race_page(html: str, race_id: str) -> Tuple[RaceInfo, List[Horse]]:
+    """出馬表ページを解析"""
+    if LexborHTMLParser is not None:
+        return _parse_race_page_lexbor(html, race_id)
+    return _parse_race_page_bs4(html, race_id)
+
+
+# 成績表でリンク文字列を優先する列（日付・開催・レース名）
+_HISTORY_LINK_COLS = (0, 1, 4)
+
+
+def _build_race_result(texts: List[str]) -> Optional[RaceResult]:
+    """成績表1行分のセル文字列からRaceResultを作成（着順が数字でなければNone）"""
+    # 列の構造（ヘッダーから推測）:
+    # 0: 日付, 1: 開催, 2: 天気, 3: R, 4: レース名, 5: 映像, 
+    # 6: 頭数, 7: 枠番, 8: 馬番, 9: オッズ, 10: 人気, 11: 着順,
+    # 12: 騎手, 13: 斤量, 14: 距離, ...
+    result = RaceResult()
+    
+    # 日付（0番目）・競馬場（1番目）・レース名（4番目）
+    result.date = texts[0]
+    result.course = texts[1]
+    result.race_name = texts[4]
+    
+    # 頭数（6番目）
+    try:
+        result.total_horses = int(texts[6])
+    except:
+        result.total_horses = 0
+    
+    # 着順（11番目）
+    finish_text = texts[11]
+    if finish_text.isdigit():
+        result.finish = int(finish_text)
+    else:
+        return None  # 着順が数字でなければスキップ（中止など）
+    
+    # 距離・コースタイプ（14番目）
+    dist_match = _RE_TRACK_DIST.search(texts[14])
+    if dist_match:
+        result.track_type = 'ダート' if dist_match.group(1) == 'ダ' else '芝'
+        result.distance = int(dist_match.group(2))
+    
+    # オッズ（9番目）
+    try:
+        result.odds = float(texts[9])
+    except:
+        pass
+    
+    # 人気（10番目）
+    try:
+        result.popularity = int(texts[10])
+    except:
+        pass
+    
+    return result
+
+
+def _parse_horse_history_lexbor(html: str) -> List[RaceResult]:
+    """馬の過去成績を解析（selectolax版）"""
+    tree = LexborHTMLParser(html)
     results = []
     
     # 成績テーブルを取得
-    table = soup.select_one('table.db_h_race_results')
-    if not table:
-        table = soup.select_one('table.nk_tb_common')
+    table = tree.css_first('table.db_h_race_results')
+    if table is None:
+        table = tree.css_first('table.nk_tb_common')
     
-    if not table:
+    if table is None:
         return results
     
     # tbodyの中のtrを取得（ヘッダーを除く）
-    tbody = table.select_one('tbody')
-    if tbody:
-        rows = tbody.select('tr')
-    else:
-        rows = table.select('tr')
+    tbody = table.css_first('tbody')
+    rows = tbody.css('tr') if tbody is not None else table.css('tr')
     
     for row in rows:
-        cells = row.select('td')
+        # 必要な先頭15列だけ取り出す（それ以降の列は見ない）
+        cells = list(islice((c for c in row.iter() if c.tag == 'td'), 15))
         if len(cells) < 15:
             continue
         
-        result = RaceResult()
+        texts = []
+        for i, cell in enumerate(cells):
+            link = cell.css_first('a') if i in _HISTORY_LINK_COLS else None
+            texts.append((link if link is not None else cell).text(strip=True))
         
-        try:
-            # 列の構造（ヘッダーから推測）:
-            # 0: 日付, 1: 開催, 2: 天気, 3: R, 4: レース名, 5: 映像, 
-            # 6: 頭数, 7: 枠番, 8: 馬番, 9: オッズ, 10: 人気, 11: 着順,
-            # 12: 騎手, 13: 斤量, 14: 距離, ...
-            
-            # 日付（0番目）
-            date_link = cells[0].select_one('a')
-            result.date = date_link.get_text(strip=True) if date_link else cells[0].get_text(strip=True)
-            
-            # 競馬場（1番目）
-            course_link = cells[1].select_one('a')
-            result.course = course_link.get_text(strip=True) if course_link else cells[1].get_text(strip=True)
-            
-            # レース名（4番目）
-            race_link = cells[4].select_one('a')
-            result.race_name = race_link.get_text(strip=True) if race_link else cells[4].get_text(strip=True)
-            
-            # 頭数（6番目）
-            try:
-                result.total_horses = int(cells[6].get_text(strip=True))
-            except:
-                result.total_horses = 0
-            
-            # 着順（11番目）
-            finish_text = cells[11].get_text(strip=True)
-            if finish_text.isdigit():
-                result.finish = int(finish_text)
-            else:
-                continue  # 着順が数字でなければスキップ（中止など）
-            
-            # 距離・コースタイプ（14番目）
-            dist_text = cells[14].get_text(strip=True)
-            dist_match = re.search(r'([芝ダ障])(\d{3,4})', dist_text)
-            if dist_match:
-                result.track_type = 'ダート' if dist_match.group(1) == 'ダ' else '芝'
-                result.distance = int(dist_match.group(2))
-            
-            # オッズ（9番目）
-            try:
-                odds_text = cells[9].get_text(strip=True)
-                result.odds = float(odds_text)
-            except:
-                pass
-            
-            # 人気（10番目）
-            try:
-                pop_text = cells[10].get_text(strip=True)
-                result.popularity = int(pop_text)
-            except:
-                pass
-            
+        result = _build_race_result(texts)
+        if result:
             results.append(result)
-            
-        except Exception as e:
+    
+    return results[:20]  # 最新20走まで
+
+
+# 成績テーブル（db_h_race_results を優先し、無ければ nk_tb_common）
+_XPATH_RESULTS_TABLE = '//table[contains(concat(" ", normalize-space(@class), " "), " db_h_race_results ")]'
+_XPATH_COMMON_TABLE = '//table[contains(concat(" ", normalize-space(@class), " "), " nk_tb_common ")]'
+
+
+# XML宣言付きの文字列を解析し直すためのパーサー（宣言の文字コードより優先してUTF-8で読む）
+_LXML_UTF8_PARSER = lxml_html.HTMLParser(encoding='utf-8')
+
+
+def _lxml_text(elem) -> str:
+    """要素のテキストを取得（BeautifulSoupの get_text(strip=True) 相当）"""
+    return ''.join(t.strip() for t in elem.itertext())
+
+
+def _parse_horse_history_lxml(html: str) -> List[RaceResult]:
+    """馬の過去成績を解析（lxml版）"""
+    results = []
+    try:
+        doc = lxml_html.fromstring(html)
+    except ValueError:
+        # 文字列にエンコーディング宣言があると lxml は解析を拒否するのでバイト列で解析し直す
+        doc = lxml_html.fromstring(html.encode('utf-8'), parser=_LXML_UTF8_PARSER)
+    except etree.ParserError:
+        # 空のページ（コメントだけの場合を含む）は成績なし
+        return results
+    
+    # 成績テーブルを取得
+    tables = doc.xpath(_XPATH_RESULTS_TABLE) or doc.xpath(_XPATH_COMMON_TABLE)
+    if not tables:
+        return results
+    table = tables[0]
+    
+    # tbodyの中のtrを取得（ヘッダーを除く）
+    tbody = table.find('.//tbody')
+    rows = (tbody if tbody is not None else table).iter('tr')
+    
+    for row in rows:
+        # 必要な先頭15列だけ取り出す（それ以降の列は見ない）
+        cells = list(islice(row.iterchildren('td'), 15))
+        if len(cells) < 15:
             continue
+        
+        texts = []
+        for i, cell in enumerate(cells):
+            link = cell.find('.//a') if i in _HISTORY_LINK_COLS else None
+            texts.append(_lxml_text(link if link is not None else cell))
+        
+        result = _build_race_result(texts)
+        if result:
+            results.append(result)
     
     return results[:20]  # 最新20走まで
 
 
-def calculate_score(horse: Horse, race_info: RaceInfo, all_horses: List[Horse]) -> Dict:
+def parse_horse_history(html: str) -> List[RaceResult]:
+    """馬の過去成績を解析"""
+    if LexborHTMLParser is not None:
+        return _parse_horse_history_lexbor(html)
+    return _parse_horse_history_lxml(html)
+
+
+def _load_cached_results(horse_id: str) -> Optional[List[RaceResult]]:
+    """解析済みの成績を読み込む（元のHTMLキャッシュが有効で、それより新しい場合のみ）"""
+    html_path = CACHE_DIR / f'{horse_id}.html'
+    pkl_path = CACHE_DIR / f'{horse_id}.results.pkl'
+    try:
+        html_mtime = html_path.stat().st_mtime
+        if time.time() - html_mtime >= HORSE_PAGE_TTL or pkl_path.stat().st_mtime < html_mtime:
+            return None
+        with pkl_path.open('rb') as f:
+            return pickle.load(f)
+    except Exception:
+        return None
+
+
+def _save_cached_results(horse_id: str, results: List[RaceResult]) -> None:
+    """解析済みの成績を保存（失敗しても処理は続ける）"""
+    pkl_path = CACHE_DIR / f'{horse_id}.results.pkl'
+    try:
+        tmp_path = _cache_tmp_path(pkl_path)
+        with tmp_path.open('wb') as f:
+            pickle.dump(results, f, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp_path.replace(pkl_path)
+    except OSError:
+        pass
+
+
+async def load_horse_history(session: aiohttp.ClientSession, horse_id: str,
+                             sem: asyncio.Semaphore, limiter: DomainRateLimiter) -> Optional[List[RaceResult]]:
+    """馬の過去成績を取得・解析（キャッシュを優先、取得失敗時はNone）"""
+    # 解析済みの成績があればHTMLの取得・解析を省略
+    results = _load_cached_results(horse_id)
+    if results is not None:
+        return results
+    
+    html_path = CACHE_DIR / f'{horse_id}.html'
+    html = _read_cache(html_path, HORSE_PAGE_TTL)
+    if html is not None:
+        results = parse_horse_history(html)
+    else:
+        async with sem:
+            body = await fetch_horse_page(session, horse_id, limiter)
+        if body is None:
+            return None
+        # 解析・キャッシュするのは成績テーブルまで
+        cut = _cut_after_results_table(body)
+        html = cut.decode(PAGE_ENCODING, errors='replace')
+        results = parse_horse_history(html)
+        if not results and len(cut) < len(body):
+            # 切り詰めた本文から成績が取れなければ、ページ全体で解析し直す
+            html = body.decode(PAGE_ENCODING, errors='replace')
+            results = parse_horse_history(html)
+        # 解析できた本文だけをキャッシュする
+        _write_cache(html_path, html)
+    
+    _save_cached_results(horse_id, results)
+    return results
+
+
+async def fetch_all_histories(horses: List[Horse],
+                              max_concurrent: int = MAX_CONCURRENT_FETCHES,
+                              min_interval: float = MIN_REQUEST_INTERVAL,
+                              verbose: bool = True) -> None:
+    """各馬の過去成績を並列に取得し、horse.results に格納（verbose=False なら進捗を表示しない）"""
+    sem = asyncio.Semaphore(max_concurrent)
+    limiter = DomainRateLimiter(min_interval)
+    
+    async def bounded_fetch(session: aiohttp.ClientSession, horse: Horse) -> None:
+        try:
+            results = await load_horse_history(session, horse.horse_id, sem, limiter)
+        except Exception:
+            # 1頭の解析失敗でレース全体を止めない（その馬は成績なしで予測）
+            results = None
+        if results is not None:
+            horse.results = results
+            if verbose:
+                print(f"   {horse.number}番 {horse.name}... ✓ ({len(horse.results)}走)")
+        elif verbose:
+            print(f"   {horse.number}番 {horse.name}... ✗")
+    
+    async with aiohttp.ClientSession(headers=HEADERS) as session:
+        await asyncio.gather(*(bounded_fetch(session, h) for h in horses if h.horse_id))
+
+
+# スコア計算の定数（呼び出しごとに作り直さない）
+_RECENT_WEIGHTS = (0.35, 0.25, 0.2, 0.12, 0.08)  # 直近5走の重み
+_ODDS_LOG_SCALE = 18                              # オッズスコアの対数の係数
+
+# 勝率推定（Softmax）の温度。除算の代わりに逆数を掛ける
+SOFTMAX_TEMPERATURE = 0.3
+_INV_TEMPERATURE = 1 / SOFTMAX_TEMPERATURE
+
+
+def calculate_score(horse: Horse, race_info: RaceInfo, n_horses: int, avg_weight: float) -> Dict:
     """馬のスコアを計算"""
     score_details = {}
     total_score = 0
     
     results = horse.results
     
+    # 過去成績を1回の走査で集計
+    recent_sum = 0
+    wins = places = 0
+    dist_runs = dist_places = 0
+    course_runs = course_places = 0
+    # 安定性用: 直近10走の着順の平均・偏差平方和（Welford法で逐次計算）
+    n_recent = 0
+    finish_mean = finish_m2 = 0.0
+    for i, r in enumerate(results):
+        placed = r.finish <= 3
+        if i < len(_RECENT_WEIGHTS):
+            # 着順をスコア化 (1着=100, 以降減少)
+            recent_sum += max(0, 100 - (r.finish - 1) * 12) * _RECENT_WEIGHTS[i]
+        if r.finish == 1:
+            wins += 1
+        if placed:
+            places += 1
+        if race_info.distance and abs(r.distance - race_info.distance) <= 100:
+            dist_runs += 1
+            dist_places += placed
+        if race_info.course and race_info.course in r.course:
+            course_runs += 1
+            course_places += placed
+        if i < 10:
+            n_recent += 1
+            delta = r.finish - finish_mean
+            finish_mean += delta / n_recent
+            finish_m2 += delta * (r.finish - finish_mean)
+    
     # 1. 近走成績スコア (35%)
     recent_score = 50
     if results:
-        weights = [0.35, 0.25, 0.2, 0.12, 0.08]
-        weighted_sum = 0
-        for i, r in enumerate(results[:5]):
-            if i < len(weights):
-                # 着順をスコア化 (1着=100, 以降減少)
-                finish_score = max(0, 100 - (r.finish - 1) * 12)
-                weighted_sum += finish_score * weights[i]
-        recent_score = weighted_sum
+        recent_score = recent_sum
     score_details['recent'] = recent_score
     total_score += recent_score * 0.35
     
     # 2. 勝率・複勝率 (15%)
     basic_score = 50
     if results:
-        wins = sum(1 for r in results if r.finish == 1)
-        places = sum(1 for r in results if r.finish <= 3)
         win_rate = wins / len(results)
         place_rate = places / len(results)
         basic_score = win_rate * 50 + place_rate * 50
@@ -388,29 +829,22 @@ def calculate_score(horse: Horse, race_info: RaceInfo, all_horses: List[Horse])
     
     # 3. 距離適性 (12%)
     distance_score = 50
-    if results and race_info.distance:
-        same_dist = [r for r in results if abs(r.distance - race_info.distance) <= 100]
-        if same_dist:
-            places = sum(1 for r in same_dist if r.finish <= 3)
-            distance_score = (places / len(same_dist)) * 100
+    if dist_runs:
+        distance_score = (dist_places / dist_runs) * 100
     score_details['distance'] = distance_score
     total_score += distance_score * 0.12
     
     # 4. コース適性 (8%)
     course_score = 50
-    if results and race_info.course:
-        same_course = [r for r in results if race_info.course in r.course]
-        if same_course:
-            places = sum(1 for r in same_course if r.finish <= 3)
-            course_score = (places / len(same_course)) * 100
+    if course_runs:
+        course_score = (course_places / course_runs) * 100
     score_details['course'] = course_score
     total_score += course_score * 0.08
     
     # 5. 枠順 (8%)
     draw_score = 50
-    total = len(all_horses)
-    if horse.number and total > 0:
-        position = (horse.number - 1) / max(total - 1, 1)
+    if horse.number and n_horses > 0:
+        position = (horse.number - 1) / max(n_horses - 1, 1)
         # 内枠有利 (短距離ほど)
         inner_bias = 0.2 if race_info.distance <= 1400 else 0.1
         draw_score = (1 - position * inner_bias) * 100
@@ -420,25 +854,21 @@ def calculate_score(horse: Horse, race_info: RaceInfo, all_horses: List[Horse])
     # 6. オッズ評価 (10%)
     odds_score = 50
     if horse.odds and horse.odds > 0:
-        odds_score = max(0, 100 - math.log(horse.odds) * 18)
+        odds_score = max(0, 100 - math.log(horse.odds) * _ODDS_LOG_SCALE)
     score_details['odds'] = odds_score
     total_score += odds_score * 0.10
     
     # 7. 安定性 (7%)
     stability_score = 50
     if len(results) >= 3:
-        finishes = [r.finish for r in results[:10]]
-        import statistics
-        std = statistics.stdev(finishes) if len(finishes) > 1 else 0
+        std = math.sqrt(finish_m2 / (n_recent - 1)) if n_recent > 1 else 0
         stability_score = max(0, 100 - std * 12)
     score_details['stability'] = stability_score
     total_score += stability_score * 0.07
     
     # 8. 斤量 (5%)
     weight_score = 50
-    weights = [h.weight_carry for h in all_horses if h.weight_carry > 0]
-    if weights and horse.weight_carry:
-        avg_weight = sum(weights) / len(weights)
+    if avg_weight and horse.weight_carry:
         diff = horse.weight_carry - avg_weight
         weight_score = 50 - diff * 8
         weight_score = max(0, min(100, weight_score))
@@ -455,8 +885,14 @@ def predict(horses: List[Horse], race_info: RaceInfo) -> List[Dict]:
     """予測を実行"""
     predictions = []
     
+    # 全馬共通の値は一度だけ計算
+    n_horses = len(horses)
+    weight_carry = np.array([h.weight_carry for h in horses], dtype=np.float64)
+    carried = weight_carry > 0
+    avg_weight = float(weight_carry[carried].mean()) if carried.any() else 0.0
+    
     for horse in horses:
-        score_data = calculate_score(horse, race_info, horses)
+        score_data = calculate_score(horse, race_info, n_horses, avg_weight)
         predictions.append({
             'horse': horse,
             'score': score_data['total'],
@@ -467,20 +903,17 @@ def predict(horses: List[Horse], race_info: RaceInfo) -> List[Dict]:
     predictions.sort(key=lambda x: x['score'], reverse=True)
     
     # 正規化・勝率計算
-    scores = [p['score'] for p in predictions]
-    min_s, max_s = min(scores), max(scores)
+    scores = np.fromiter((p['score'] for p in predictions), dtype=np.float64, count=len(predictions))
+    min_s, max_s = scores.min(), scores.max()
+    norm = (scores - min_s) / (max_s - min_s) if max_s > min_s else np.full_like(scores, 0.5)
     
     # Softmax で勝率推定
-    temperature = 0.3
-    exp_scores = []
-    for p in predictions:
-        norm = (p['score'] - min_s) / (max_s - min_s) if max_s > min_s else 0.5
-        p['norm_score'] = norm
-        exp_scores.append(math.exp(norm / temperature))
+    exp_scores = np.exp(norm * _INV_TEMPERATURE)
+    win_probs = exp_scores / exp_scores.sum()
     
-    total_exp = sum(exp_scores)
-    for i, p in enumerate(predictions):
-        p['win_prob'] = exp_scores[i] / total_exp
+    for i, (p, n, w) in enumerate(zip(predictions, norm, win_probs)):
+        p['norm_score'] = float(n)
+        p['win_prob'] = float(w)
         p['rank'] = i + 1
         
         # 期待値
@@ -568,12 +1001,69 @@ def display_results(predictions: List[Dict], race_info: RaceInfo):
     print(sep)
 
 
+def score_one_race(race_id: str, workers: int = 1) -> Dict:
+    """1レース分の取得・解析・予測を行う（batch_main のワーカー用）
+    
+    workers は並列に動いているプロセス数。同時取得数とリクエスト間隔をこれで割り振る。
+    他のプロセスと出力が混ざるため、進捗はレースIDを付けた完了時の1行だけを表示する。
+    失敗した場合は例外を送出せず、result['error'] に内容を入れて返す。
+    """
+    result = {'race_id': race_id, 'race_info': None, 'predictions': [], 'error': None}
+    
+    try:
+        html = fetch_race_page(race_id, verbose=False)
+        if not html:
+            result['error'] = "出馬表を取得できませんでした"
+        else:
+            race_info, horses = parse_race_page(html, race_id)
+            result['race_info'] = race_info
+            if horses:
+                asyncio.run(fetch_all_histories(
+                    horses,
+                    max_concurrent=max(1, MAX_CONCURRENT_FETCHES // workers),
+                    min_interval=MIN_REQUEST_INTERVAL * workers,
+                    verbose=False,
+                ))
+                result['predictions'] = predict(horses, race_info)
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    
+    if result['predictions']:
+        print(f"   {race_id}... ✓ ({len(result['predictions'])}頭)")
+    else:
+        print(f"   {race_id}... ✗")
+    return result
+
+
+def batch_main(race_ids: List[str]) -> None:
+    """複数レースをプロセス並列で予測し、レースID順に結果を表示"""
+    workers = min(MAX_BATCH_WORKERS, len(race_ids))
+    print(f"\n🔮 {len(race_ids)}レースを予測中（{workers}プロセス）...")
+    
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        results = list(ex.map(score_one_race, race_ids, [workers] * len(race_ids)))
+    
+    for result in results:
+        if result['error']:
+            print(f"\n❌ {result['race_id']}: エラー ({result['error']})")
+            continue
+        if not result['predictions']:
+            print(f"\n❌ {result['race_id']}: 馬データを取得できませんでした")
+            continue
+        display_results(result['predictions'], result['race_info'])
+
+
 def main():
     """メイン処理"""
     print("=" * 90)
     print("       競馬予測システム - netkeiba スクレイピング版")
     print("=" * 90)
     
+    # 複数のレースIDが指定された場合はまとめて予測
+    if len(sys.argv) > 2:
+        batch_main(sys.argv[1:])
+        return
+    
     # レースID（コマンドライン引数または デフォルト）
     race_id = sys.argv[1] if len(sys.argv) > 1 else "202508040701"
     
@@ -606,17 +1096,9 @@ def main():
     # 3. 各馬の過去成績を取得
     print(f"\n📈 各馬の過去成績を取得中...")
     for horse in horses:
-        if horse.horse_id:
-            print(f"   {horse.number}番 {horse.name}...", end=" ", flush=True)
-            horse_html = fetch_horse_page(horse.horse_id)
-            if horse_html:
-                horse.results = parse_horse_history(horse_html)
-                print(f"✓ ({len(horse.results)}走)")
-            else:
-                print("✗")
-            time.sleep(0.3)  # サーバー負荷軽減
-        else:
+        if not horse.horse_id:
             print(f"   {horse.number}番 {horse.name}... (IDなし・新馬?)")
+    asyncio.run(fetch_all_histories(horses))
     
     # 4. 出走馬一覧
     print(f"\n📋 出走馬一覧:")